@@ -1,7 +1,16 @@
+import functools
+import io
+import math
+import os
+import threading
+import wave
+
 import numpy as np
 import soundfile as sf
 import matplotlib.pyplot as plt
 import streamlit as st
+from numba import njit
+from scipy.signal import find_peaks
 
 # Constants
 DTMF_FREQS = {
@@ -10,15 +19,49 @@ DTMF_FREQS = {
     '7': (852, 1209), '8': (852, 1336), '9': (852, 1477),
     '0': (941, 1336), '*': (941, 1209), '#': (941, 1477)
 }
+DTMF_LOW_FREQS = np.array(sorted({low for low, _ in DTMF_FREQS.values()}), dtype=np.float64)
+DTMF_HIGH_FREQS = np.array(sorted({high for _, high in DTMF_FREQS.values()}), dtype=np.float64)
+DTMF_BANK_FREQS = np.concatenate([DTMF_LOW_FREQS, DTMF_HIGH_FREQS])
+DTMF_KEYS = {freqs: key for key, freqs in DTMF_FREQS.items()}
+DTMF_KEY_GRID = np.array([[DTMF_KEYS[(low, high)] for high in DTMF_HIGH_FREQS] for low in DTMF_LOW_FREQS])
+DTMF_LOW_BAND = (650, 1000)
+DTMF_HIGH_BAND = (1150, 1550)
+PEAK_RATIO_SIGMAS = 4
+MAX_TWIST_DB = 12
+DECODE_SAMPLE_RATE = 8000
+# Bump TONES_VERSION whenever tone synthesis changes so stale cached matrices are regenerated.
+TONES_VERSION = 1
+TONES_FILE = "dtmf_tones_v{version}_{sample_rate:g}hz_{n_samples}.npy"
+
+# Sine lookup table, indexed by the top LUT_BITS of a PHASE_BITS-wide phase accumulator
+LUT_BITS = 16
+LUT = np.sin(2 * np.pi * np.arange(1 << LUT_BITS) / (1 << LUT_BITS)).astype(np.float32)
+LUT_MASK = (1 << LUT_BITS) - 1
+PHASE_BITS = 32
 
 # Utility Functions
-def generate_tone(frequency, t):
-    """Generate a sine wave for a given frequency and time array."""
-    return np.sin(2 * np.pi * frequency * t)
+@functools.lru_cache(maxsize=8)
+def _sample_index(n_samples):
+    """Return a shared, read-only sample index 0..n_samples-1."""
+    index = np.arange(n_samples, dtype=np.int64)
+    index.flags.writeable = False
+    return index
+
+def generate_tone(frequency, n_samples, sample_rate, phase=0.0):
+    """Generate sine waves for a frequency (or array of frequencies) from the lookup table."""
+    step = np.round(np.asarray(frequency, dtype=np.float64) * (1 << PHASE_BITS) / sample_rate)
+    offset = round(phase / (2 * np.pi) * (1 << PHASE_BITS))
+    accumulator = _sample_index(n_samples) * step.astype(np.int64)[..., None] + offset
+    return LUT[(accumulator >> (PHASE_BITS - LUT_BITS)) & LUT_MASK]
+
+def _to_int16_inplace(audio, axis=-1):
+    """Scale a float32 array in place to peak at the int16 maximum along `axis` and return it as int16."""
+    audio *= np.float32(np.iinfo(np.int16).max) / np.abs(audio).max(axis=axis, keepdims=True)
+    return audio.astype(np.int16)
 
 def normalize_audio(audio):
     """Normalize audio to 16-bit PCM range."""
-    return np.int16(audio / np.max(np.abs(audio)) * 32767)
+    return _to_int16_inplace(np.array(audio, dtype=np.float32), axis=None)
 
 def sanitize_filename(key):
     """Generate sanitized filenames for DTMF tones."""
@@ -30,7 +73,16 @@ def read_audio_file(uploaded_file):
 
 def save_audio_file(audio_data, sample_rate, filename):
     """Save audio data to a .wav file."""
-    sf.write(filename, audio_data, sample_rate)
+    audio_data = np.asarray(audio_data)
+    if audio_data.dtype != np.int16 or audio_data.ndim != 1:
+        sf.write(filename, audio_data, sample_rate)
+        return
+    # Mono 16-bit PCM, which is all the tone export writes, goes straight out through the stdlib.
+    with wave.open(filename, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(audio_data.astype('<i2', copy=False).tobytes())
 
 # DTMF Tone Generation
 def generate_dtmf_tone(key, sample_rate=11025, duration=0.5):
@@ -39,89 +91,246 @@ def generate_dtmf_tone(key, sample_rate=11025, duration=0.5):
         raise ValueError(f"Invalid key: {key}. Choose from 0-9, *, #.")
     
     low_freq, high_freq = DTMF_FREQS[key]
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    dtmf_tone = generate_tone(low_freq, t) + generate_tone(high_freq, t)
-    return normalize_audio(dtmf_tone), sample_rate
+    n_samples = int(sample_rate * duration)
+    # sin(a) + sin(b) = 2 * sin((a + b) / 2) * cos((a - b) / 2); normalization absorbs the factor 2.
+    sum_freq, diff_freq = (low_freq + high_freq) / 2, (high_freq - low_freq) / 2
+    dtmf_tone = (generate_tone(sum_freq, n_samples, sample_rate) *
+                 generate_tone(diff_freq, n_samples, sample_rate, phase=np.pi / 2))
+    return _to_int16_inplace(dtmf_tone), sample_rate
+
+def generate_all_dtmf_tones(sample_rate=11025, duration=0.5):
+    """Generate the DTMF tones for all keys as a single (12, N) int16 matrix."""
+    freqs = np.array(list(DTMF_FREQS.values()), dtype=np.float64)  # (12, 2)
+    sum_freqs = freqs.sum(axis=1) / 2
+    diff_freqs = (freqs[:, 1] - freqs[:, 0]) / 2
+    n_samples = int(sample_rate * duration)
+    tones = (generate_tone(sum_freqs, n_samples, sample_rate) *
+             generate_tone(diff_freqs, n_samples, sample_rate, phase=np.pi / 2))
+    return _to_int16_inplace(tones, axis=1), sample_rate
+
+def load_all_tones(sample_rate=11025, duration=0.5):
+    """Load the (12, N) DTMF tone matrix from disk, generating and saving it on first use.
+
+    The cache file name records the synthesis version, sample rate and sample count, so a file
+    written for other settings or by an older synthesizer is never reused. A truncated or corrupt
+    file is regenerated.
+    """
+    n_samples = int(sample_rate * duration)
+    filename = TONES_FILE.format(version=TONES_VERSION, sample_rate=sample_rate, n_samples=n_samples)
+    if os.path.exists(filename):
+        try:
+            return np.load(filename, mmap_mode="r"), sample_rate
+        except (ValueError, OSError):
+            pass
+    tones, sample_rate = generate_all_dtmf_tones(sample_rate, duration)
+    np.save(filename, tones)
+    return tones, sample_rate
 
 def generate_and_save_all_tones():
-    """Generate and save DTMF tones for all keys."""
-    for key in DTMF_FREQS:
-        audio_data, sample_rate = generate_dtmf_tone(key)
+    """Save DTMF tones for all keys as .wav files."""
+    int_tones, sample_rate = load_all_tones()
+    for key, audio_data in zip(DTMF_FREQS, int_tones):
         save_audio_file(audio_data, sample_rate, sanitize_filename(key))
         print(f"Saved: {sanitize_filename(key)}")
 
 # Plotting Functions
+@st.cache_resource
+def _plot_lock():
+    """Return the lock serializing use of the shared figures across sessions and reruns."""
+    # Cached, not module-level: Streamlit re-executes this script and would make a new lock each run.
+    return threading.Lock()
+
+@st.cache_resource
+def _make_figure(kind, figsize=(10, 4)):
+    """Create the figure, axes and line for a plot kind once and reuse them across reruns."""
+    fig, ax = plt.subplots(figsize=figsize)
+    (line,) = ax.plot([], [])
+    ax.grid(True)
+    return fig, ax, line
+
+def _update_figure(kind, x, data, title, xlabel, ylabel, figsize=(10, 4)):
+    """Load new data and labels into the cached figure for a plot kind; hold _plot_lock() while calling."""
+    fig, ax, line = _make_figure(kind, figsize)
+    line.set_data(x, data)
+    for text in list(ax.texts):
+        text.remove()
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.relim()
+    ax.autoscale_view()
+    return fig, ax, line
+
 def plot_signal(data, x, title, xlabel, ylabel):
     """Helper function to plot signals."""
-    plt.figure(figsize=(10, 4))
-    plt.plot(x, data)
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.grid(True)
-    st.pyplot(plt)
+    with _plot_lock():
+        fig, _, _ = _update_figure(title, x, data, title, xlabel, ylabel)
+        st.pyplot(fig, clear_figure=False)
 
 def plot_time_domain(audio_data, sample_rate):
-    """Plot the time-domain signal with labels for each sample."""
-    time = np.linspace(0, len(audio_data) / sample_rate, num=len(audio_data))
+    """Plot the time-domain signal, labelling the peak-amplitude sample."""
     samples_to_plot = audio_data[:100]
-    times_to_plot = time[:100]
-
-    plt.figure(figsize=(12, 6))
-    plt.plot(times_to_plot, samples_to_plot, marker='o')
-    for i, (x, y) in enumerate(zip(times_to_plot, samples_to_plot)):
-        plt.text(x, y, f"{y:.2f}", fontsize=8, ha='center', va='bottom')
-
-    plt.title("Time Domain Signal (First 100 Samples)")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Amplitude")
-    plt.grid(True)
-    st.pyplot(plt)
-
-def plot_frequency_domain(audio_data, sample_rate):
-    """Plot the frequency-domain (FFT) spectrum."""
-    fft_result = np.fft.fft(audio_data)
-    freq = np.fft.fftfreq(len(audio_data), 1 / sample_rate)[:len(fft_result) // 2]
-    fft_magnitude = np.abs(fft_result[:len(fft_result) // 2])
-
-    dominant_indices = np.argsort(fft_magnitude)[-2:]
+    times_to_plot = np.arange(len(samples_to_plot)) / sample_rate
+
+    with _plot_lock():
+        fig, ax, line = _update_figure("time_domain", times_to_plot, samples_to_plot,
+                                       "Time Domain Signal (First 100 Samples)", "Time (s)", "Amplitude",
+                                       figsize=(12, 6))
+        line.set_marker('o')
+        if len(samples_to_plot):
+            i = np.argmax(np.abs(samples_to_plot))
+            ax.text(times_to_plot[i], samples_to_plot[i], f"{samples_to_plot[i]:.2f}",
+                    fontsize=8, ha='center', va='bottom')
+
+        st.pyplot(fig, clear_figure=False)
+
+def find_dtmf_peaks(freq, fft_magnitude, min_prominence=0.1):
+    """Return the most prominent spectrum peak in the DTMF row band and in the column band."""
+    if len(fft_magnitude) == 0:
+        return np.array([], dtype=int)
+    prominence = min_prominence * fft_magnitude.max()
+    peaks = []
+    for low, high in (DTMF_LOW_BAND, DTMF_HIGH_BAND):
+        band = np.flatnonzero((freq >= low) & (freq <= high))
+        band_peaks, properties = find_peaks(fft_magnitude[band], prominence=prominence)
+        if len(band_peaks):
+            peaks.append(band[band_peaks[np.argmax(properties['prominences'])]])
+    return np.array(peaks, dtype=int)
+
+def compute_spectrum(audio_data, sample_rate):
+    """Compute the plotted spectrum and the labelled DTMF peaks for some audio data."""
+    fft_magnitude = np.abs(np.fft.rfft(audio_data))
+    freq = np.fft.rfftfreq(len(audio_data), 1 / sample_rate)
+
+    dominant_indices = find_dtmf_peaks(freq, fft_magnitude)
     dominant_freqs = freq[dominant_indices]
-    plt.figure(figsize=(10, 4))
-    plt.plot(freq, fft_magnitude, label='FFT Magnitude')
-    plt.title("Frequency Spectrum")
-    plt.xlabel("Frequency (Hz)")
-    plt.ylabel("Magnitude")
-    plt.grid(True)
+    dominant_magnitudes = fft_magnitude[dominant_indices]
+
+    # ~1000 points is plenty for the plot width; keep each block's maximum so narrow tone peaks survive.
+    step = max(1, len(fft_magnitude) // 1000)
+    n_bins = len(fft_magnitude) // step * step
+    plot_freq = freq[:n_bins:step]
+    plot_magnitude = fft_magnitude[:n_bins].reshape(-1, step).max(axis=1)
+    return plot_freq, plot_magnitude, dominant_freqs, dominant_magnitudes
+
+def plot_frequency_domain(audio_data, sample_rate, spectrum=None):
+    """Plot the frequency-domain (FFT) spectrum, optionally from a precomputed compute_spectrum()."""
+    if spectrum is None:
+        spectrum = compute_spectrum(audio_data, sample_rate)
+    plot_freq, plot_magnitude, dominant_freqs, dominant_magnitudes = spectrum
+    with _plot_lock():
+        fig, ax, line = _update_figure("frequency_domain", plot_freq, plot_magnitude,
+                                       "Frequency Spectrum", "Frequency (Hz)", "Magnitude")
+        line.set_label('FFT Magnitude')
 
-    for i in range(2):
-        plt.text(dominant_freqs[i], fft_magnitude[dominant_indices[i]], 
-                 f"{dominant_freqs[i]:.1f} Hz", 
-                 fontsize=10, ha='center', va='bottom', color='red')
+        for freq, magnitude in zip(dominant_freqs, dominant_magnitudes):
+            ax.text(freq, magnitude, f"{freq:.1f} Hz",
+                    fontsize=10, ha='center', va='bottom', color='red')
 
-    st.pyplot(plt)
+        st.pyplot(fig, clear_figure=False)
 
 # DTMF Identification
+@njit(cache=True, fastmath=True)
+def goertzel_power(frames, coeffs):
+    """Run a Goertzel filter bank over each frame and return the power per frame and filter."""
+    n_frames, frame_length = frames.shape
+    n_filters = coeffs.shape[0]
+    power = np.empty((n_frames, n_filters))
+    s_prev = np.empty(n_filters)
+    s_prev2 = np.empty(n_filters)
+    for f in range(n_frames):
+        s_prev[:] = 0.0
+        s_prev2[:] = 0.0
+        for i in range(frame_length):
+            x = frames[f, i]
+            for k in range(n_filters):
+                s = x + coeffs[k] * s_prev[k] - s_prev2[k]
+                s_prev2[k] = s_prev[k]
+                s_prev[k] = s
+        for k in range(n_filters):
+            power[f, k] = s_prev2[k] ** 2 + s_prev[k] ** 2 - coeffs[k] * s_prev[k] * s_prev2[k]
+    return power
+
+# Compile the kernel at import so the first upload in the app doesn't pay for it.
+goertzel_power(np.zeros((0, 1)), np.zeros(len(DTMF_BANK_FREQS)))
+
+def boxcar_decimate(audio_data, factor):
+    """Downsample audio by averaging non-overlapping blocks of `factor` samples, per channel."""
+    n_samples = len(audio_data) // factor * factor
+    return audio_data[:n_samples].reshape(-1, factor, *audio_data.shape[1:]).mean(axis=1)
+
 def identify_dtmf_key(audio_data, sample_rate, tolerance=20):
     """Identify the DTMF key from the audio data."""
-    fft_result = np.fft.fft(audio_data)
-    freq = np.fft.fftfreq(len(audio_data), 1 / sample_rate)[:len(fft_result) // 2]
-    fft_magnitude = np.abs(fft_result[:len(fft_result) // 2])
-    dominant_freqs = freq[np.argsort(fft_magnitude)[-2:]]
+    audio_data = np.asarray(audio_data)
+    if audio_data.ndim > 1:
+        # sf.read returns (N, channels) for multichannel files; the tones are decoded from the mix.
+        audio_data = audio_data.mean(axis=1)
 
-    for key, (low_freq, high_freq) in DTMF_FREQS.items():
-        if (np.isclose(dominant_freqs, [low_freq, high_freq], atol=tolerance).all() or
-            np.isclose(dominant_freqs, [high_freq, low_freq], atol=tolerance).all()):
-            return key
-    return None
+    # Each DTMF frequency is flanked by guard filters one Goertzel bin (2 * tolerance) either side;
+    # a tone more than `tolerance` Hz off-nominal, or leakage from a far-away tone, favours a guard.
+    bank_freqs = np.concatenate([DTMF_BANK_FREQS, DTMF_BANK_FREQS - 2 * tolerance,
+                                 DTMF_BANK_FREQS + 2 * tolerance])
+
+    # DTMF lies below 1.5 kHz, so recordings well above telephone rate are averaged down first.
+    factor = max(1, int(sample_rate // DECODE_SAMPLE_RATE))
+    gain = 1.0
+    if factor > 1:
+        audio_data = boxcar_decimate(audio_data, factor)
+        # Undo the boxcar's droop at the bank frequencies so row and column powers stay comparable.
+        x = np.pi * bank_freqs / sample_rate
+        gain = np.sin(factor * x) / (factor * np.sin(x))
+        sample_rate /= factor
+
+    # Short frames keep tones up to `tolerance` Hz off-nominal inside the Goertzel main lobe;
+    # anything shorter than one frame (including empty input) is too short to tell the tones apart.
+    frame_length = int(sample_rate / (2 * tolerance))
+    if frame_length == 0 or len(audio_data) < frame_length:
+        return None
+    n_frames = len(audio_data) // frame_length
+    frames = np.ascontiguousarray(audio_data[:n_frames * frame_length], dtype=np.float64)
+    frames = frames.reshape(n_frames, frame_length)
+
+    coeffs = 2 * np.cos(2 * np.pi * bank_freqs / sample_rate)
+    power, below, above = np.split(goertzel_power(frames, coeffs).sum(axis=0) / gain ** 2, 3)
+    n_low = len(DTMF_LOW_FREQS)
+    i_low = np.argmax(power[:n_low])
+    i_high = n_low + np.argmax(power[n_low:])
+    low_power, high_power = power[i_low], power[i_high]
+    if min(low_power, high_power) == 0:
+        return None
+    if any(power[i] < max(below[i], above[i]) for i in (i_low, i_high)):
+        return None
+
+    # Noise-only bank powers summed over n_frames spread by about 1 / sqrt(n_frames), so each
+    # winner must beat the runner-up in its group by several of those spreads.
+    min_ratio = 1 + PEAK_RATIO_SIGMAS / math.sqrt(n_frames)
+    runner_up_low = np.partition(power[:n_low], -2)[-2]
+    runner_up_high = np.partition(power[n_low:], -2)[-2]
+    if low_power < min_ratio * runner_up_low or high_power < min_ratio * runner_up_high:
+        return None
+    if abs(10 * math.log10(high_power / low_power)) > MAX_TWIST_DB:
+        return None
+    return str(DTMF_KEY_GRID[i_low, i_high - n_low])
 
 # Streamlit Application
+@st.cache_data(show_spinner=False, max_entries=16)
+def _decode_upload(file_bytes):
+    """Read an uploaded .wav file, identify its key and compute its spectrum once per upload."""
+    audio_data, sample_rate = read_audio_file(io.BytesIO(file_bytes))
+    return (audio_data, sample_rate, identify_dtmf_key(audio_data, sample_rate),
+            compute_spectrum(audio_data, sample_rate))
+
 def dtmf_app():
     """Streamlit GUI application for DTMF decoding."""
     st.title('DTMF Decoder Application')
+    if st.sidebar.button("Export DTMF tone WAVs"):
+        generate_and_save_all_tones()
+        st.sidebar.success("Saved DTMF tone files for all keys.")
+
     uploaded_file = st.file_uploader("Upload a DTMF tone (.wav file)", type="wav")
 
     if uploaded_file:
-        audio_data, sample_rate = read_audio_file(uploaded_file)
+        audio_data, sample_rate, identified_key, spectrum = _decode_upload(uploaded_file.getvalue())
         st.write(f"Sampling Rate: {sample_rate} Hz")
         
 
@@ -129,9 +338,8 @@ def dtmf_app():
         plot_time_domain(audio_data, sample_rate)
 
         st.subheader("Frequency Domain Analysis")
-        plot_frequency_domain(audio_data, sample_rate)
+        plot_frequency_domain(audio_data, sample_rate, spectrum)
 
-        identified_key = identify_dtmf_key(audio_data, sample_rate)
         st.subheader(f"Identified DTMF Key: {identified_key}" if identified_key else 
                      "Unable to identify the DTMF key.")
     else:
@@ -139,5 +347,4 @@ def dtmf_app():
 
 # Main Entry Point
 if __name__ == "__main__":
-    generate_and_save_all_tones()
     dtmf_app()